@@ -4,10 +4,26 @@ import argparse
 import subprocess
 import sys
 import os
-import shutil
 from datetime import datetime
 import time
 import json
+import mmap
+import queue
+import threading
+import atexit
+import shlex
+import getpass
+import hashlib
+import re
+import errno
+import glob
+import signal
+import fcntl
+import struct
+import string
+import stat
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 # Global variables
 DEBUG = False
@@ -19,62 +35,417 @@ CREATE_DOCS = False
 CREATE_TAILS = False
 KALI_ISO = ""
 TAILS_ISO = ""
+ISO_SHA256 = ""
 DRIVE = ""
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+BLOCK_SIZE = None  # None until set by --bs or picked for the selected drive
+DIRECT_IO_ALIGNMENT = 4096
+WIPE_SIZE = 10 * 1024 * 1024
+CALIBRATION_BLOCK_SIZES = [256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024]
+CALIBRATION_BYTES = 32 * 1024 * 1024
+WIPE_FAST_PATH = True
+# Block device ioctls from <linux/fs.h>: _IO(0x12, 95), _IO(0x12, 119) and _IO(0x12, 127)
+BLKRRPART = 0x125F
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+LUKS_ITER_TIME = 5000
+LUKS_PBKDF = "argon2id"
+ASSUME_YES = False
+
+# lsblk trees keyed by drive (None for all drives), cleared whenever the partition table changes
+LSBLK_CACHE = {}
+
+# Partitions already cleared by wipe_partitions() during this run
+WIPED_PARTITIONS = set()
+
+# Files written to the unencrypted partition; $docs_part is filled in with the documents partition
+README_TEXT = """
+To mount the encrypted documents partition, use the provided 'mount_encrypted_partitions.sh' script.
+To unmount and lock it, use the 'cleanup_encrypted_partitions.sh' script.
+
+**Automount Script:**
+Run: sudo ./mount_encrypted_partitions.sh
+
+**Cleanup Script:**
+Run: sudo ./cleanup_encrypted_partitions.sh
+"""
+
+MOUNT_SCRIPT_TEMPLATE = string.Template("""#!/bin/bash
+# Script to mount encrypted documents partition
+
+echo "Available drives:"
+lsblk -o NAME,SIZE,TYPE | grep disk
+read -p "Enter the drive path for the documents partition (default: $docs_part): " DRIVE_PATH
+DRIVE_PATH=$${DRIVE_PATH:-$docs_part}
+
+if [ -b "$$DRIVE_PATH" ]; then
+    echo "Mounting VeraCrypt documents partition at $$DRIVE_PATH..."
+    sudo mkdir -p /mnt/veracrypt_docs
+    sudo veracrypt --text --mount "$$DRIVE_PATH" /mnt/veracrypt_docs
+    echo "Documents partition mounted at /mnt/veracrypt_docs."
+else
+    echo "Error: Partition $$DRIVE_PATH not found."
+fi
+""")
+
+CLEANUP_SCRIPT_TEMPLATE = string.Template("""#!/bin/bash
+# Script to unmount and lock encrypted documents partition
+
+echo "Available drives:"
+lsblk -o NAME,SIZE,TYPE | grep disk
+read -p "Enter the drive path for the documents partition (default: $docs_part): " DRIVE_PATH
+DRIVE_PATH=$${DRIVE_PATH:-$docs_part}
+
+echo "Unmounting and locking encrypted documents partition at $$DRIVE_PATH..."
+
+if mountpoint -q /mnt/veracrypt_docs; then
+    sudo veracrypt --text --dismount /mnt/veracrypt_docs
+    echo "VeraCrypt documents partition unmounted."
+else
+    echo "Documents partition is not currently mounted."
+fi
+""")
+
+# Opened once, on the first message, in append mode and block buffered; flush_log() pushes the buffer out
+# before prompts and before child processes write to the same file
+LOG_FH = None
+LOG_BUFFER_SIZE = 8192
+
+# log() only enqueues; a background thread does the file and terminal writes
+LOG_QUEUE = queue.Queue()
+LOG_FLUSH = object()  # Queued by flush_log() to have the worker flush the file
+LOG_FILE_FAILED = False  # Set once the log file cannot be written; messages then only reach the terminal
+
+def open_log_file():
+    """Returns the open log file, (re)opening it if needed."""
+    global LOG_FH
+    if LOG_FH is None or LOG_FH.name != LOG_FILE:
+        if LOG_FH is not None:
+            old_fh, LOG_FH = LOG_FH, None
+            old_fh.close()
+        LOG_FH = open(LOG_FILE, "a", buffering=LOG_BUFFER_SIZE)
+    return LOG_FH
+
+def log_file_failed(error):
+    """Warns once that the log file cannot be written."""
+    global LOG_FILE_FAILED
+    if not LOG_FILE_FAILED:
+        LOG_FILE_FAILED = True
+        print(f"Warning: cannot write log file {LOG_FILE}: {error}", file=sys.stderr)
+
+def log_worker():
+    while True:
+        message = LOG_QUEUE.get()
+        # Every message must be marked done, or flush_log() (and with it every prompt and command) waits forever
+        try:
+            if message is None:
+                break
+            if message is LOG_FLUSH:
+                if LOG_FH is not None:
+                    LOG_FH.flush()
+                continue
+            try:
+                open_log_file().write(message + "\n")
+            except OSError as e:
+                log_file_failed(e)
+            try:
+                print(message)
+            except OSError:
+                pass  # The terminal went away (e.g. a closed pipe); keep the log file going
+        except Exception as e:
+            log_file_failed(e)
+        finally:
+            LOG_QUEUE.task_done()
+
+LOG_THREAD = threading.Thread(target=log_worker, daemon=True)
+LOG_THREAD.start()
+
+def flush_log():
+    """Waits until every queued message is written and flushed, so prompts and child output never overtake them."""
+    LOG_QUEUE.put(LOG_FLUSH)
+    LOG_QUEUE.join()
+
+def close_log():
+    LOG_QUEUE.put(None)
+    LOG_THREAD.join()
+    if LOG_FH is not None:
+        try:
+            LOG_FH.close()
+        except OSError:
+            pass
+
+atexit.register(close_log)
 
 def log(message):
-    with open(LOG_FILE, "a") as log_file:
-        log_file.write(message + "\n")
-    print(message)
+    LOG_QUEUE.put(message)
 
-def run_command(command, shell=False, interactive=False):
+def log_fd():
+    """Returns the log file descriptor for a child process to write its output into, after all queued messages.
+
+    Falls back to our stderr if the log file cannot be written.
+    """
+    flush_log()
+    try:
+        return open_log_file().fileno()
+    except OSError as e:
+        log_file_failed(e)
+        return sys.stderr.fileno()
+
+def ask(prompt):
+    flush_log()
+    return input(prompt)
+
+def prompt_yes(question, default=True):
+    """Asks a y/n question and returns True for yes; always yes with --yes."""
+    if ASSUME_YES:
+        log(f"{question} (y/n): y (--yes)")
+        return True
+    answer = ask(f"{question} (y/n) [Default: {'y' if default else 'n'}]: ") or ("y" if default else "n")
+    return answer.lower().startswith("y")
+
+class SudoShell:
+    """A long-lived root bash fed over stdin, so each privileged command skips a fresh sudo fork+exec."""
+
+    SENTINEL = "__COVERT_SD_DONE__"
+
+    def __init__(self):
+        # Not "sudo -i": the shell must keep our working directory so relative paths still resolve.
+        # When we are already root, sudo would only add its PAM and audit overhead
+        self.process = subprocess.Popen(
+            ["bash"] if os.geteuid() == 0 else ["sudo", "bash"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,  # Carries only the completion sentinels; stderr stays ours
+            text=True,
+            bufsize=1
+        )
+        self.lock = threading.Lock()
+
+    def run(self, command, output_path):
+        """Runs command in the shell, appending its stdout/stderr to output_path, and returns its exit status."""
+        with self.lock:
+            # stdin is the command channel, so commands get /dev/null; only the sentinel comes back over stdout
+            self.process.stdin.write(
+                f"{{ {command}\n}} < /dev/null >> {shlex.quote(output_path)} 2>&1\nprintf '{self.SENTINEL}%d\\n' $?\n"
+            )
+            self.process.stdin.flush()
+            for line in self.process.stdout:
+                if line.startswith(self.SENTINEL):
+                    return int(line[len(self.SENTINEL):])
+            # The shell went away (e.g. the command called exit); report failure
+            return 1
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            self.process.wait()
+
+SUDO_SHELL = None
+
+def get_sudo_shell():
+    global SUDO_SHELL
+    if SUDO_SHELL is None or not SUDO_SHELL.alive():
+        SUDO_SHELL = SudoShell()
+        atexit.register(SUDO_SHELL.close)
+    return SUDO_SHELL
+
+def run_sudo_command(command, check=True):
+    """Runs an argv list that starts with sudo through the persistent root shell."""
+    command = shlex.join(command[1:])
+    # Make sure the log file exists (owned by us) and holds every earlier message; without one, output goes to stderr
+    output_path = "/dev/stderr" if log_fd() == sys.stderr.fileno() else os.path.abspath(LOG_FILE)
+    status = get_sudo_shell().run(command, output_path)
+    if status != 0:
+        log(f"Command failed with exit status {status}: sudo {command} (output in {LOG_FILE})")
+        if check:
+            sys.exit(1)
+        return False
+    return True
+
+def strip_sudo(command):
+    """Drops a leading sudo from an argv list."""
+    return command[1:] if command[:1] == ["sudo"] else command
+
+def as_root(command):
+    """Returns command ready to run with root privileges: unchanged under sudo, without the sudo when already root."""
+    return strip_sudo(command) if os.geteuid() == 0 else command
+
+def run_command(command, interactive=False, input_text=None, check=True):
+    """Runs an argv list, exiting on failure unless check is False; returns whether it succeeded."""
     if DEBUG:
         log(f"Running command: {command}")
+    # Commands that read input_text need their own stdin, so they cannot go through the shared root shell
+    if not interactive and input_text is None and command[0] == "sudo":
+        return run_sudo_command(command, check)
+    command = as_root(command)  # Already root; skip the extra sudo process
     try:
         if interactive:
-            subprocess.run(command, shell=shell, check=True)
+            flush_log()
+            subprocess.run(command, check=True)
         else:
-            result = subprocess.run(
+            # The child writes straight into the log file instead of through a pipe and log()
+            subprocess.run(
                 command,
-                shell=shell,
                 check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
+                input=input_text.encode() if input_text is not None else None,
+                stdout=log_fd(),
+                stderr=subprocess.STDOUT
             )
-            if result.stdout:
-                log(result.stdout.strip())
-            if result.stderr:
-                log(result.stderr.strip())
     except subprocess.CalledProcessError as e:
-        log(f"Command failed: {e}\nOutput: {e.stdout}\nError: {e.stderr}")
-        sys.exit(1)
+        log(f"Command failed: {e} (output in {LOG_FILE})")
+        if check:
+            sys.exit(1)
+        return False
+    return True
+
+def list_executables():
+    """Returns the names of all executables on PATH, listing each directory once."""
+    executables = set()
+    for directory in os.get_exec_path():
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        executables.add(entry.name)
+        except OSError:
+            pass
+    return executables
+
+def broken_packages(packages):
+    """Returns the packages dpkg knows about but that are not fully installed, using one dpkg-query call."""
+    result = subprocess.run(
+        ["dpkg-query", "-W", "-f=${Package}\t${Status}\n"] + packages,
+        capture_output=True,
+        text=True
+    )
+    broken = set()
+    for line in result.stdout.splitlines():
+        package, _, status = line.partition("\t")
+        if status != "install ok installed":
+            broken.add(package)
+    return broken
 
 def check_dependencies():
-    dependencies = ["parted", "cryptsetup", "lsblk", "dd", "sgdisk", "wipefs", "bc", "fdisk", "veracrypt", "lsof", "fuser", "mountpoint", "udevadm"]
-    missing = []
-    for dep in dependencies:
-        if not shutil.which(dep):
-            missing.append(dep)
+    # Command -> Debian package that provides it
+    dependencies = {
+        "parted": "parted",
+        "cryptsetup": "cryptsetup",
+        "lsblk": "util-linux",
+        "dd": "coreutils",
+        "sgdisk": "gdisk",
+        "wipefs": "util-linux",
+        "bc": "bc",
+        "fdisk": "fdisk",
+        "veracrypt": "veracrypt",
+        "lsof": "lsof",
+        "fuser": "psmisc",
+        "mountpoint": "util-linux",
+        "udevadm": "udev"
+    }
+    executables = list_executables()
+    # Packages dpkg reports as half-installed count as missing even if their command exists;
+    # without dpkg (non-Debian hosts) only PATH is checked
+    broken = broken_packages(sorted(set(dependencies.values()))) if "dpkg-query" in executables else set()
+    missing = [dep for dep, package in dependencies.items() if dep not in executables or package in broken]
     if missing:
         log(f"Missing dependencies: {', '.join(missing)}")
-        install = input(f"Do you want to install the missing dependencies? (y/n) [Default: y]: ") or "y"
-        if install.lower() == "y":
+        if prompt_yes("Do you want to install the missing dependencies?"):
+            packages = list(dict.fromkeys(dependencies[dep] for dep in missing))
             run_command(["sudo", "apt", "update"])
-            run_command(["sudo", "apt", "install", "-y"] + missing)
+            run_command(["sudo", "apt", "install", "-y"] + packages)
         else:
             log("Cannot proceed without installing dependencies. Exiting.")
             sys.exit(1)
 
+    # As root the discard is issued directly with an ioctl
+    optional_dependencies = {} if os.geteuid() == 0 else {"blkdiscard": "wipes will zero the start of the drive instead of discarding it"}
+    for dep, fallback in optional_dependencies.items():
+        if dep not in executables:
+            log(f"Optional dependency {dep} not found: {fallback}.")
+
+def lsblk_devices(drive=None, refresh=False):
+    """Returns the lsblk JSON device tree for all drives (or just the given one), including mountpoints.
+
+    Results are cached until reread_partitions() or refresh=True, since the tree only changes when we repartition.
+    """
+    if refresh or drive not in LSBLK_CACHE:
+        command = ["lsblk", "-J", "-p", "-o", "NAME,SIZE,TYPE,MOUNTPOINT"]
+        if drive:
+            command.append(drive)
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            log(f"Error: lsblk failed: {result.stderr.strip()}")
+            sys.exit(1)
+        LSBLK_CACHE[drive] = json.loads(result.stdout)['blockdevices']
+    return LSBLK_CACHE[drive]
+
+def iter_block_devices(devices):
+    """Yields every device in an lsblk tree, children included."""
+    for device in devices:
+        yield device
+        yield from iter_block_devices(device.get('children', []))
+
 def list_drives():
+    """Logs the available disks and returns the lsblk tree so prepare_drive can reuse it."""
     log("Available drives:")
-    result = subprocess.run(["lsblk", "-J", "-o", "NAME,SIZE,TYPE"], capture_output=True, text=True)
-    lsblk_output = json.loads(result.stdout)
-    for device in lsblk_output['blockdevices']:
+    devices = lsblk_devices()
+    for device in devices:
         if device['type'] == 'disk':
-            name = device['name']
-            size = device['size']
-            drive = f"/dev/{name} {size}"
-            log(drive)
+            log(f"{device['name']} {device['size']}")
+    return devices
+
+def reread_partition_table_ioctl(drive):
+    """Asks the kernel to re-read the partition table with BLKRRPART; returns False if that is not possible."""
+    if os.geteuid() != 0:
+        return False
+    try:
+        fd = os.open(drive, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    except OSError as e:
+        # EBUSY while any partition is still open; partprobe can update the partitions one by one instead
+        if DEBUG:
+            log(f"BLKRRPART failed on {drive}: {e}")
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+def reread_partitions(drive, partition_numbers=()):
+    """Makes the kernel pick up a new partition table on drive and waits for the device nodes."""
+    if not reread_partition_table_ioctl(drive):
+        run_command(["sudo", "partprobe", drive])
+    if partition_numbers:
+        wait_for_partitions(drive, partition_numbers)
+    else:
+        run_command(["sudo", "udevadm", "settle", "--timeout=10"])
+    LSBLK_CACHE.clear()
+
+def wait_for_partitions(drive, partition_numbers, timeout=10):
+    """Returns as soon as the device nodes for the given partitions exist, exiting if they do not appear in time."""
+    deadline = time.monotonic() + timeout
+    for number in partition_numbers:
+        path = get_partition_name(drive, number)
+        while not os.path.exists(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log(f"Error: Partition {path} did not appear within {timeout} seconds.")
+                sys.exit(1)
+            # Wakes up when the node is created instead of waiting for the whole udev queue to drain
+            run_command(["sudo", "udevadm", "settle", f"--timeout={max(1, int(remaining))}", f"--exit-if-exists={path}"], check=False)
+            if not os.path.exists(path):
+                time.sleep(0.1)  # udev has not seen the partition event yet
+
+def wipe_partitions(drive, partition_numbers):
+    """Clears leftover signatures from new partitions in one wipefs call, so the setup steps need not wipe them again."""
+    # A new partition can start where an old LUKS or VeraCrypt header still sits, so fresh is not the same as blank
+    parts = [get_partition_name(drive, number) for number in partition_numbers]
+    run_command(["sudo", "wipefs", "--all"] + parts)
+    WIPED_PARTITIONS.update(parts)
 
 def get_partition_name(drive, partition_number):
     if 'nvme' in drive or 'mmcblk' in drive:
@@ -82,29 +453,66 @@ def get_partition_name(drive, partition_number):
     else:
         return f"{drive}{partition_number}"
 
-def prepare_drive(drive):
-    result = subprocess.run(["lsblk", "-lnp", drive], capture_output=True, text=True)
-    for line in result.stdout.strip().splitlines():
-        parts = line.strip().split()
-        if len(parts) >= 7 and parts[6]:  # If mountpoint is not empty
-            part = parts[0]
+def processes_using(drive):
+    """Returns {pid: command name} for processes holding drive open, read from /proc (needs root)."""
+    target = os.path.realpath(drive)
+    holders = {}
+    own_fd_dir = f"/proc/{os.getpid()}/fd"
+    for fd_dir in glob.glob("/proc/[0-9]*/fd"):
+        if fd_dir == own_fd_dir:
+            continue
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue  # The process exited
+        for fd in fds:
+            try:
+                if os.readlink(f"{fd_dir}/{fd}") != target:
+                    continue
+                pid = int(fd_dir.split("/")[2])
+                with open(f"/proc/{pid}/comm") as f:
+                    holders[pid] = f.read().strip()
+            except OSError:
+                continue
+            break
+    return holders
+
+def prepare_drive(drive, devices=None):
+    # Reuse the tree list_drives already fetched; only ask lsblk again if the drive is not in it
+    drive_devices = [device for device in devices or [] if device['name'] == drive] or lsblk_devices(drive)
+    swap_parts = []
+    for device in iter_block_devices(drive_devices):
+        mountpoint = device.get('mountpoint')
+        if mountpoint == "[SWAP]":  # lsblk reports active swap partitions this way
+            swap_parts.append(device['name'])
+        elif mountpoint:
+            part = device['name']
             log(f"Unmounting {part}...")
             run_command(["sudo", "umount", "-l", part])
 
-    with open("/proc/swaps") as swaps_file:
-        for line in swaps_file:
-            if drive in line:
-                swap_part = line.strip().split()[0]
-                log(f"Disabling swap on {swap_part}...")
-                run_command(["sudo", "swapoff", swap_part])
+    if swap_parts:
+        log(f"Disabling swap on {', '.join(swap_parts)}...")
+        run_command(["sudo", "swapoff"] + swap_parts)
 
     log(f"Checking for processes using {drive}...")
-    result = subprocess.run(["sudo", "lsof", drive], capture_output=True, text=True)
-    if result.stdout.strip():
-        log(f"Processes using {drive}:\n{result.stdout}")
-        kill = input(f"Do you want to kill these processes? (y/n) [Default: y]: ") or "y"
-        if kill.lower() == "y":
-            run_command(["sudo", "fuser", "-k", drive])
+    if os.geteuid() == 0:
+        # As root every process's fd table is readable, so no lsof/fuser processes are needed
+        holders = processes_using(drive)
+        users = "\n".join(f"{pid} {comm}" for pid, comm in holders.items())
+    else:
+        holders = None
+        users = subprocess.run(["sudo", "lsof", drive], capture_output=True, text=True).stdout.strip()
+    if users:
+        log(f"Processes using {drive}:\n{users}")
+        if prompt_yes("Do you want to kill these processes?"):
+            if holders is None:
+                run_command(["sudo", "fuser", "-k", drive])
+            else:
+                for pid in holders:
+                    try:
+                        os.kill(pid, signal.SIGKILL)  # What fuser -k sends
+                    except ProcessLookupError:
+                        pass
             log(f"Killed processes using {drive}.")
         else:
             log("Cannot proceed while processes are using the drive. Exiting.")
@@ -112,26 +520,335 @@ def prepare_drive(drive):
     else:
         log(f"No processes are using {drive}.")
 
+def parse_size(value):
+    """Parses a dd-style size such as 4096, 512K, 16M or 1G into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    number, unit = value, 1
+    if value[-1:].upper() in units:
+        number, unit = value[:-1], units[value[-1].upper()]
+    try:
+        size = int(number) * unit
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+    if size <= 0 or size % DIRECT_IO_ALIGNMENT:
+        raise argparse.ArgumentTypeError(f"size must be a positive multiple of {DIRECT_IO_ALIGNMENT} bytes: {value}")
+    return size
+
+def default_block_size(drive):
+    """Returns DEFAULT_BLOCK_SIZE rounded up to a multiple of the drive's optimal I/O size, if it reports one."""
+    try:
+        with open(f"/sys/class/block/{os.path.basename(drive)}/queue/optimal_io_size") as f:
+            optimal_io_size = int(f.read())
+    except (OSError, ValueError):
+        optimal_io_size = 0
+    if optimal_io_size <= 0 or optimal_io_size % DIRECT_IO_ALIGNMENT:
+        return DEFAULT_BLOCK_SIZE
+    return -(-DEFAULT_BLOCK_SIZE // optimal_io_size) * optimal_io_size
+
+def drive_model(drive):
+    """Returns the drive's ID_MODEL from udev, or None if udev does not know it."""
+    result = subprocess.run(["udevadm", "info", "--query=property", f"--name={drive}"], capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition("=")
+        if key == "ID_MODEL" and value:
+            return value
+    return None
+
+def available_memory():
+    """Returns MemAvailable from /proc/meminfo in bytes, or None if it cannot be read."""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def calibration_cache_dir():
+    """Returns a directory for cached calibration results that only we can write to, or None."""
+    if os.geteuid() == 0:
+        path = "/var/cache/covert_sd_card_tool"
+    else:
+        path = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "covert_sd_card_tool")
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+    except OSError:
+        return None
+    # Refuse a symlink or a directory someone else owns or can write into, so nobody can plant a result
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o022:
+        return None
+    return path
+
+def calibrate_block_size(drive):
+    """Times direct writes of zeros over the start of the drive for each candidate block size and returns the fastest.
+
+    Only call this when the start of the drive is about to be overwritten anyway (i.e. before writing an ISO).
+    """
+    model = drive_model(drive)
+    cache_dir = calibration_cache_dir() if model else None
+    cache_path = f"{cache_dir}/bs_{re.sub(r'[^A-Za-z0-9_.-]', '_', model)}.json" if cache_dir else None
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            with open(os.open(cache_path, os.O_RDONLY | os.O_NOFOLLOW)) as cache_file:
+                block_size = int(json.load(cache_file)["block_size"])
+            if block_size > 0 and block_size % DIRECT_IO_ALIGNMENT == 0:
+                log(f"Using cached block size {block_size} for {model}.")
+                return block_size
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    memory = available_memory()
+    candidates = [size for size in CALIBRATION_BLOCK_SIZES if memory is None or size <= memory // 4]
+    log(f"Calibrating block size on {drive}...")
+    timings = {}
+    for size in candidates:
+        start = time.monotonic()
+        result = subprocess.run(
+            as_root(["sudo", "dd", "if=/dev/zero", f"of={drive}", f"bs={size}", f"count={CALIBRATION_BYTES // size}", "oflag=direct", "conv=fsync"]),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        if result.returncode != 0:
+            continue
+        timings[size] = time.monotonic() - start
+        if DEBUG:
+            log(f"bs={size}: {CALIBRATION_BYTES / timings[size] / (1024 * 1024):.1f} MiB/s")
+    if not timings:
+        log("Block size calibration failed; using the default.")
+        return default_block_size(drive)
+
+    block_size = min(timings, key=timings.get)
+    log(f"Selected block size {block_size} ({CALIBRATION_BYTES / timings[block_size] / (1024 * 1024):.1f} MiB/s).")
+    if cache_path:
+        try:
+            fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+            with open(fd, "w") as cache_file:
+                json.dump({"block_size": block_size}, cache_file)
+        except OSError:
+            pass
+    return block_size
+
+def discard_drive(drive):
+    """Discards every block on the drive; returns False if the drive (or blkdiscard) does not support it."""
+    if os.geteuid() != 0:
+        return run_command(["sudo", "blkdiscard", "-f", drive], check=False)
+    try:
+        fd = os.open(drive, os.O_WRONLY)
+    except OSError as e:
+        log(f"Error opening {drive}: {e}")
+        sys.exit(1)
+    try:
+        fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", 0, os.lseek(fd, 0, os.SEEK_END)))
+    except OSError as e:
+        if DEBUG:
+            log(f"Discard not supported on {drive}: {e}")
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+def zero_head(drive, size=WIPE_SIZE):
+    """Overwrites at least the first size bytes of the drive with zeros, in whole BLOCK_SIZE writes."""
+    blocks = -(-size // BLOCK_SIZE)
+    size = blocks * BLOCK_SIZE
+    if os.geteuid() != 0:
+        run_command(["sudo", "dd", "if=/dev/zero", f"of={drive}", f"bs={BLOCK_SIZE}", f"count={blocks}", "oflag=direct"])
+        return
+    fd = os.open(drive, os.O_WRONLY)
+    try:
+        try:
+            # Let the kernel (or the device itself) zero the range without us sending any data
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", 0, size))
+            return
+        except OSError:
+            pass  # Not a block device, or zeroing is unsupported; write the zeros ourselves
+        buf = bytes(size)
+        written = 0
+        while written < size:
+            written += os.write(fd, buf[written:])
+        os.fsync(fd)
+    except OSError as e:
+        log(f"Error zeroing {drive}: {e}")
+        sys.exit(1)
+    finally:
+        os.close(fd)
+
+def write_iso(iso_path, drive, block_size):
+    """Copies the ISO onto the drive with O_DIRECT writes taken straight from a read-only mapping of the ISO.
+
+    Returns False without touching the drive if direct I/O is not available, so the caller can fall back to dd.
+    """
+    if os.geteuid() != 0:
+        return False
+    try:
+        dst_fd = os.open(drive, os.O_WRONLY | os.O_DIRECT)
+    except OSError as e:
+        if DEBUG:
+            log(f"Direct I/O not available on {drive}: {e}")
+        return False
+
+    total = os.path.getsize(iso_path)
+    total_mib = total // (1024 * 1024)
+    offset = 0
+    flush_log()  # The progress line below is written directly to the terminal
+    try:
+        with open(iso_path, "rb") as src:
+            if total:
+                # The mapping is page-aligned and block_size is a multiple of 4096, so every block
+                # slice satisfies O_DIRECT's alignment rules and needs no bounce buffer
+                src_map = mmap.mmap(src.fileno(), 0, prot=mmap.PROT_READ)
+                src_map.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(src_map)
+            while offset < total:
+                n = min(block_size, total - offset)
+                # Start paging in the next block while this one is being written
+                next_start = offset + n
+                if next_start < total:
+                    page_start = next_start - next_start % mmap.PAGESIZE
+                    src_map.madvise(mmap.MADV_WILLNEED, page_start, min(block_size, total - page_start))
+                aligned = n - n % DIRECT_IO_ALIGNMENT
+                written = 0
+                while written < aligned:
+                    written += os.write(dst_fd, view[offset + written:offset + aligned])
+                if aligned < n:
+                    # O_DIRECT cannot write a partial block, so the unaligned tail goes through the page cache
+                    tail_fd = os.open(drive, os.O_WRONLY)
+                    try:
+                        os.pwrite(tail_fd, view[offset + aligned:offset + n], offset + aligned)
+                        os.fsync(tail_fd)
+                    finally:
+                        os.close(tail_fd)
+                offset += n
+                sys.stdout.write(f"\r{offset // (1024 * 1024)} MiB / {total_mib} MiB")
+                sys.stdout.flush()
+            if total:
+                view.release()
+                src_map.close()
+        os.fsync(dst_fd)
+    except OSError as e:
+        sys.stdout.write("\n")
+        log(f"Error writing ISO to {drive}: {e}")
+        sys.exit(1)
+    finally:
+        os.close(dst_fd)
+    sys.stdout.write("\n")
+    return True
+
+def sendfile_iso(iso_path, drive, block_size):
+    """Copies the ISO onto the drive with sendfile, keeping the data in the kernel (for drives without O_DIRECT).
+
+    Returns False without touching the drive if sendfile is not usable, so the caller can fall back to dd.
+    """
+    if os.geteuid() != 0:
+        return False
+    total = os.path.getsize(iso_path)
+    total_mib = total // (1024 * 1024)
+    offset = 0
+    src_fd = os.open(iso_path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(drive, os.O_WRONLY)
+    except OSError as e:
+        os.close(src_fd)
+        log(f"Error opening {drive}: {e}")
+        sys.exit(1)
+    flush_log()  # The progress line below is written directly to the terminal
+    try:
+        os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while offset < total:
+            try:
+                n = os.sendfile(dst_fd, src_fd, offset, min(block_size, total - offset))
+            except OSError as e:
+                if offset == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    if DEBUG:
+                        log(f"sendfile not available on {drive}: {e}")
+                    return False
+                raise
+            if n == 0:
+                sys.stdout.write("\n")
+                log(f"Error writing ISO to {drive}: copy stopped at {offset} of {total} bytes.")
+                sys.exit(1)
+            offset += n
+            sys.stdout.write(f"\r{offset // (1024 * 1024)} MiB / {total_mib} MiB")
+            sys.stdout.flush()
+        os.fsync(dst_fd)
+    except OSError as e:
+        sys.stdout.write("\n")
+        log(f"Error writing ISO to {drive}: {e}")
+        sys.exit(1)
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+    sys.stdout.write("\n")
+    return True
+
+def expected_iso_sha256(iso_path):
+    """Returns the expected SHA-256 from --sha256, <iso>.sha256 or a SHA256SUMS file next to the ISO, if any."""
+    if ISO_SHA256:
+        return ISO_SHA256.lower()
+    iso_name = os.path.basename(iso_path)
+    for sums_path in (f"{iso_path}.sha256", os.path.join(os.path.dirname(iso_path), "SHA256SUMS")):
+        if not os.path.isfile(sums_path):
+            continue
+        with open(sums_path) as sums_file:
+            for line in sums_file:
+                fields = line.split()
+                if len(fields) == 1 and sums_path.endswith(".sha256"):
+                    return fields[0].lower()
+                if len(fields) >= 2 and fields[-1].lstrip("*") == iso_name:
+                    return fields[0].lower()
+    return None
+
+def verify_iso(iso_path):
+    expected = expected_iso_sha256(iso_path)
+    if not expected:
+        log("No SHA-256 checksum provided for the ISO. Skipping verification.")
+        return
+
+    log(f"Verifying SHA-256 checksum of {iso_path}...")
+    with open(iso_path, "rb") as iso_file:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+: hashes in C straight from the file, using OpenSSL's accelerated SHA-256
+            digest = hashlib.file_digest(iso_file, "sha256").hexdigest()
+        else:
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: iso_file.read(BLOCK_SIZE), b""):
+                sha256.update(chunk)
+            digest = sha256.hexdigest()
+
+    if digest != expected:
+        log(f"Error: ISO checksum mismatch (expected {expected}, got {digest}).")
+        sys.exit(1)
+    log("ISO checksum verified.")
+
 def setup_usb():
-    global DRIVE
+    global DRIVE, BLOCK_SIZE
     log("Setting up bootable USB or preparing partitions...")
-    list_drives()
-    DRIVE = input("Enter the drive to use for USB (e.g., /dev/sda) [Default: /dev/sda]: ") or "/dev/sda"
+    devices = list_drives()
+    DRIVE = ask("Enter the drive to use for USB (e.g., /dev/sda) [Default: /dev/sda]: ") or "/dev/sda"
 
-    confirm = input(f"You have selected {DRIVE}. Is this correct? (y/n) [Default: y]: ") or "y"
-    if confirm.lower() != "y":
+    if not prompt_yes(f"You have selected {DRIVE}. Is this correct?"):
         log("Drive selection canceled. Exiting.")
         sys.exit(1)
 
-    prepare_drive(DRIVE)
+    prepare_drive(DRIVE, devices)
+
+    # Calibrating writes to the start of the drive, so it waits until the ISO has been checked (below);
+    # until then (e.g. for the wipe) the default size is used
+    calibrate = BLOCK_SIZE is None and (CREATE_KALI or CREATE_TAILS)
+    if BLOCK_SIZE is None:
+        BLOCK_SIZE = default_block_size(DRIVE)
 
     if CREATE_KALI or CREATE_TAILS or CREATE_DOCS:
-        wipe = input(f"Do you want to wipe the drive {DRIVE} before starting? (y/n) [Default: n]: ") or "n"
-        if wipe.lower() == "y":
+        if prompt_yes(f"Do you want to wipe the drive {DRIVE} before starting?", default=False):
             log(f"Wiping {DRIVE} and clearing any existing file system or encryption signatures...")
-            run_command(["sudo", "wipefs", "--all", DRIVE])
-            run_command(["sudo", "sgdisk", "--zap-all", DRIVE])
-            run_command(["sudo", "dd", "if=/dev/zero", f"of={DRIVE}", "bs=1M", "count=10"])
+            # Clear signatures and both GPT copies in one root shell submission
+            run_command(["sudo", "bash", "-c", f"wipefs --all {shlex.quote(DRIVE)} && sgdisk --zap-all {shlex.quote(DRIVE)}"])
+            # On flash that supports discard, the whole drive is cleared without writing to it
+            if not (WIPE_FAST_PATH and discard_drive(DRIVE)):
+                zero_head(DRIVE)
+            LSBLK_CACHE.clear()
             log(f"{DRIVE} wiped successfully.")
 
     # Initialize variables to track if ISO has been written
@@ -141,22 +858,39 @@ def setup_usb():
         global KALI_ISO, TAILS_ISO
         if CREATE_KALI:
             if not KALI_ISO:
-                KALI_ISO = input("Enter the path to the Kali ISO file: ")
+                KALI_ISO = ask("Enter the path to the Kali ISO file: ")
             if not os.path.isfile(KALI_ISO):
                 log(f"Error: Kali ISO file not found at {KALI_ISO}")
                 sys.exit(1)
             ISO_PATH = KALI_ISO
         elif CREATE_TAILS:
             if not TAILS_ISO:
-                TAILS_ISO = input("Enter the path to the Tails ISO file: ")
+                TAILS_ISO = ask("Enter the path to the Tails ISO file: ")
             if not os.path.isfile(TAILS_ISO):
                 log(f"Error: Tails ISO file not found at {TAILS_ISO}")
                 sys.exit(1)
             ISO_PATH = TAILS_ISO
 
+        verify_iso(ISO_PATH)
+
+        if calibrate:
+            BLOCK_SIZE = calibrate_block_size(DRIVE)
+        if DEBUG:
+            log(f"Using block size {BLOCK_SIZE} for {DRIVE}")
+
         log(f"Writing ISO to {DRIVE}...")
-        run_command(f"sudo dd if='{ISO_PATH}' of='{DRIVE}' bs=64M status=progress", shell=True, interactive=True)
-        log(f"ISO written to {DRIVE} successfully.")
+        start = time.monotonic()
+        if not (write_iso(ISO_PATH, DRIVE, BLOCK_SIZE) or sendfile_iso(ISO_PATH, DRIVE, BLOCK_SIZE)):
+            dd_cmd = ["sudo", "dd", f"if={ISO_PATH}", f"of={DRIVE}", f"bs={BLOCK_SIZE}", "conv=fsync", "status=progress"]
+            # As root we only get here after the drive refused an O_DIRECT open, so oflag=direct would fail too
+            if os.geteuid() != 0:
+                dd_cmd.append("oflag=direct")
+            run_command(dd_cmd, interactive=True)
+        elapsed = time.monotonic() - start
+        LSBLK_CACHE.clear()  # The ISO brings its own partition table
+        # The terminal progress line is not logged, so record the overall throughput
+        iso_mib = os.path.getsize(ISO_PATH) / (1024 * 1024)
+        log(f"ISO written to {DRIVE} successfully ({iso_mib:.0f} MiB in {elapsed:.1f} s, {iso_mib / max(elapsed, 0.001):.1f} MiB/s).")
         iso_written = True
 
     # After writing ISO, set up partitions accordingly
@@ -176,26 +910,63 @@ def setup_usb():
         # Let's call it to ensure documents partition is created
         fix_partition_table_docs_only()
 
+def read_sysfs_mib(path):
+    """Reads a sysfs size/start attribute (always in 512-byte sectors) and returns it in MiB."""
+    with open(path) as f:
+        return int(f.read()) * 512 / (1024 * 1024)
+
+def drive_size_bytes(drive):
+    """Returns the drive size in bytes from sysfs, asking lsblk only if sysfs has no entry for the drive."""
+    try:
+        with open(f"/sys/class/block/{os.path.basename(os.path.realpath(drive))}/size") as f:
+            return int(f.read()) * 512
+    except (OSError, ValueError):
+        result = subprocess.run(["lsblk", "-b", "-d", "-n", "-o", "SIZE", drive], capture_output=True, text=True)
+        try:
+            return int(result.stdout.strip())
+        except ValueError:
+            log("Error: Unable to determine drive size.")
+            sys.exit(1)
+
+def sysfs_probe_drive(drive):
+    """Returns the same layout as probe_drive() without running parted, or None if sysfs has no entry for the drive."""
+    sysfs_dir = f"/sys/class/block/{os.path.basename(drive)}"
+    try:
+        probe = {'total_mib': read_sysfs_mib(f"{sysfs_dir}/size"), 'parts': []}
+        for entry in os.scandir(sysfs_dir):
+            if not os.path.exists(f"{entry.path}/partition"):
+                continue
+            with open(f"{entry.path}/partition") as f:
+                num = int(f.read())
+            start = read_sysfs_mib(f"{entry.path}/start")
+            probe['parts'].append({'num': num, 'start': start, 'end': start + read_sysfs_mib(f"{entry.path}/size")})
+    except (OSError, ValueError):
+        return None
+    return probe
+
+def probe_drive(drive):
+    """Returns the drive size and partitions (in MiB) from one machine-readable parted call."""
+    result = subprocess.run(as_root(["sudo", "parted", "-sm", drive, "unit", "MiB", "print"]), capture_output=True, text=True)
+    probe = {'total_mib': None, 'parts': []}
+    for line in result.stdout.strip().splitlines():
+        # Records look like "/dev/sda:15360MiB:scsi:512:512:msdos:Model:;" and "1:1.00MiB:3000MiB:2999MiB:::;"
+        fields = line.strip().rstrip(';').split(':')
+        if fields[0] == drive and len(fields) >= 2:
+            probe['total_mib'] = float(fields[1].replace('MiB', ''))
+        elif fields[0].isdigit() and len(fields) >= 3:
+            start = float(fields[1].replace('MiB', ''))
+            end = float(fields[2].replace('MiB', ''))
+            probe['parts'].append({'num': int(fields[0]), 'start': start, 'end': end})
+    return probe
+
 def fix_partition_table_docs_only():
     log("Setting up partitions for documents only...")
 
-    # Clear existing partitions if any
-    run_command(f"sudo parted -a optimal -s {DRIVE} mklabel gpt", shell=True)
-    run_command(f"sudo partprobe {DRIVE}", shell=True)
-    run_command("sudo udevadm settle", shell=True)
-    time.sleep(5)  # Increased sleep to ensure partitions are recognized
-
     # Get the total size of the drive in bytes
-    result = subprocess.run(["lsblk", "-b", "-n", "-o", "SIZE", DRIVE], capture_output=True, text=True)
-    try:
-        total_size_bytes = int(result.stdout.strip())
-    except ValueError:
-        log("Error: Unable to determine drive size.")
-        sys.exit(1)
-    total_size_mib = total_size_bytes / (1024 * 1024)  # Convert to MiB
+    total_size_mib = drive_size_bytes(DRIVE) / (1024 * 1024)  # Convert to MiB
 
     # Ask for document partition size
-    size_docs = input("Enter size for documents partition in GB (leave blank to use remaining space minus 1GB): ")
+    size_docs = ask("Enter size for documents partition in GB (leave blank to use remaining space minus 1GB): ")
     start_docs_mib = 1  # Starting immediately after the first MiB
     if size_docs:
         try:
@@ -210,83 +981,71 @@ def fix_partition_table_docs_only():
     else:
         end_docs_mib = total_size_mib - 1024  # Reserve 1GB for unencrypted partition
 
-    # Create documents partition
-    run_command(f"sudo parted -a optimal -s {DRIVE} mkpart primary {start_docs_mib}MiB {end_docs_mib}MiB", shell=True)
-    log("Created documents partition.")
-
-    # Create unencrypted partition
     start_unencrypted_mib = end_docs_mib
-    run_command(f"sudo parted -a optimal -s {DRIVE} mkpart primary {start_unencrypted_mib}MiB 100%", shell=True)
+
+    # Clear existing partitions and create both new ones in a single parted run
+    run_command([
+        "sudo", "parted", "-a", "optimal", "-s", DRIVE,
+        "mklabel", "gpt",
+        "mkpart", "primary", f"{start_docs_mib}MiB", f"{end_docs_mib}MiB",
+        "mkpart", "primary", f"{start_unencrypted_mib}MiB", "100%"
+    ])
+    log("Created documents partition.")
     log("Created unencrypted partition for scripts/instructions.")
 
     # Refresh partition table to recognize new partitions
-    run_command(f"sudo partprobe {DRIVE}", shell=True)
-    run_command("sudo udevadm settle", shell=True)
-    time.sleep(5)  # Increased sleep to ensure partitions are recognized
+    reread_partitions(DRIVE, [1, 2])
+    wipe_partitions(DRIVE, [1])
 
-    setup_unencrypted_partition()
+    setup_unencrypted_partition(docs_partition=1)
     setup_docs_partition()
 
 def fix_partition_table():
     log("Fixing partition table to reclaim remaining space...")
 
-    # Attempt to delete partition 2 if it exists
-    try:
-        run_command(f"sudo parted -a optimal -s {DRIVE} rm 2", shell=True)
-        log("Deleted partition 2.")
-    except SystemExit:
-        log("No partition 2 to delete.")
+    # The raw ISO write does not tell the kernel about the new table, so sysfs may still show the old
+    # (or, after a wipe, no) partitions until it is re-read
+    reread_partitions(DRIVE)
 
-    # Get the end of partition 1
-    result = subprocess.run(["sudo", "parted", "-s", DRIVE, "unit", "MiB", "print"], capture_output=True, text=True)
-    end_of_p1 = None
-    for line in result.stdout.strip().splitlines():
-        if line.strip().startswith("1"):
-            parts = line.strip().split()
-            if len(parts) >= 3:
-                end_of_p1 = parts[2].replace('MiB', '')
-                break
+    # Get the end of partition 1 and the total size of the drive, from sysfs when the kernel exposes them
+    probe = sysfs_probe_drive(DRIVE)
+    if probe is None or not any(part['num'] == 1 for part in probe['parts']):
+        probe = probe_drive(DRIVE)
+    end_of_p1 = next((part['end'] for part in probe['parts'] if part['num'] == 1), None)
     if end_of_p1 is None:
         log("Error: Could not find end of partition 1.")
         sys.exit(1)
 
     log(f"End of partition 1: {end_of_p1}MiB")
 
-    # Get the total size of the drive in bytes
-    result = subprocess.run(["lsblk", "-b", "-n", "-o", "SIZE", DRIVE], capture_output=True, text=True)
-    try:
-        total_size_bytes = int(result.stdout.strip())
-    except ValueError:
+    total_size_mib = probe['total_mib']
+    if total_size_mib is None:
         log("Error: Unable to determine drive size.")
         sys.exit(1)
-    total_size_mib = total_size_bytes / (1024 * 1024)  # Convert to MiB
 
     # Ask for persistence partition size
-    size_persistence = input("Enter size for persistence partition in GB (e.g., 4): ") or "4"
+    size_persistence = ask("Enter size for persistence partition in GB (e.g., 4): ") or "4"
     try:
         size_persistence_gb = float(size_persistence)
     except ValueError:
         log("Invalid size entered for persistence partition. Exiting.")
         sys.exit(1)
 
-    start_persistence_mib = float(end_of_p1)
-    end_persistence_mib = start_persistence_mib + (size_persistence_gb * 1024)
+    # Whole-MiB boundaries keep the LUKS2 data area a multiple of its 4096-byte sectors
+    start_persistence_mib = math.ceil(end_of_p1)
+    end_persistence_mib = start_persistence_mib + round(size_persistence_gb * 1024)
 
     if end_persistence_mib > total_size_mib:
         log("Error: Persistence partition size exceeds available space.")
         sys.exit(1)
 
-    # Create persistence partition
-    run_command(f"sudo parted -a optimal -s {DRIVE} mkpart primary {start_persistence_mib}MiB {end_persistence_mib}MiB", shell=True)
-    log("Created persistence partition.")
-
     # Set up documents partition
     start_docs_mib = end_persistence_mib
-    size_docs = input("Enter size for documents partition in GB (leave blank to use remaining space minus 1GB): ")
+    size_docs = ask("Enter size for documents partition in GB (leave blank to use remaining space minus 1GB): ")
     if size_docs:
         try:
             size_docs_gb = float(size_docs)
-            end_docs_mib = start_docs_mib + (size_docs_gb * 1024)
+            end_docs_mib = start_docs_mib + round(size_docs_gb * 1024)
             if end_docs_mib > (total_size_mib - 1024):
                 log("Error: Documents partition size exceeds available space when reserving 1GB for unencrypted partition.")
                 sys.exit(1)
@@ -294,47 +1053,94 @@ def fix_partition_table():
             log("Invalid size entered for documents partition. Exiting.")
             sys.exit(1)
     else:
-        end_docs_mib = total_size_mib - 1024  # Reserve 1GB for unencrypted partition
-
-    run_command(f"sudo parted -a optimal -s {DRIVE} mkpart primary {start_docs_mib}MiB {end_docs_mib}MiB", shell=True)
-    log("Created documents partition.")
+        end_docs_mib = math.floor(total_size_mib - 1024)  # Reserve 1GB for unencrypted partition
 
-    # Create unencrypted partition
     start_unencrypted_mib = end_docs_mib
-    run_command(f"sudo parted -a optimal -s {DRIVE} mkpart primary {start_unencrypted_mib}MiB 100%", shell=True)
+
+    # Apply all table changes in a single parted run: one table rewrite instead of one per partition
+    parted_cmds = []
+    if any(part['num'] == 2 for part in probe['parts']):
+        # Drop the ISO's second partition to reclaim the remaining space
+        parted_cmds += ["rm", "2"]
+    parted_cmds += [
+        "mkpart", "primary", f"{start_persistence_mib}MiB", f"{end_persistence_mib}MiB",
+        "mkpart", "primary", f"{start_docs_mib}MiB", f"{end_docs_mib}MiB",
+        "mkpart", "primary", f"{start_unencrypted_mib}MiB", "100%"
+    ]
+    run_command(["sudo", "parted", "-a", "optimal", "-s", DRIVE] + parted_cmds)
+    if parted_cmds[0] == "rm":
+        log("Deleted partition 2.")
+    log("Created persistence partition.")
+    log("Created documents partition.")
     log("Created unencrypted partition for scripts/instructions.")
 
-    # Refresh partition table to recognize new partitions
-    run_command(f"sudo partprobe {DRIVE}", shell=True)
-    run_command("sudo udevadm settle", shell=True)
-    time.sleep(5)  # Increased sleep to ensure partitions are recognized
+    # Refresh partition table to recognize new partitions (the ISO keeps partition 1)
+    reread_partitions(DRIVE, [2, 3, 4])
+    wipe_partitions(DRIVE, [2, 3])
 
-    setup_kali_partition()
-    if CREATE_DOCS:
-        setup_docs_partition()
-    setup_unencrypted_partition()
+    setup_encrypted_partitions()
+    setup_unencrypted_partition(docs_partition=3 if CREATE_DOCS else None)
 
 def fix_partition_table_tails():
     log("Setting up partition table for Tails...")
 
-    # Clear existing partitions if any
-    run_command(f"sudo parted -a optimal -s {DRIVE} mklabel gpt", shell=True)
-    run_command(f"sudo partprobe {DRIVE}", shell=True)
-    run_command("sudo udevadm settle", shell=True)
-    time.sleep(5)  # Increased sleep to ensure partitions are recognized
-
+    # Clear existing partitions and create the new one in a single parted run.
     # Tails typically does not require a persistence partition, but we'll create an unencrypted partition for scripts/instructions
-    run_command(f"sudo parted -a optimal -s {DRIVE} mkpart primary 1MiB 100%", shell=True)
+    run_command(["sudo", "parted", "-a", "optimal", "-s", DRIVE, "mklabel", "gpt", "mkpart", "primary", "1MiB", "100%"])
     log("Created unencrypted partition for scripts/instructions.")
 
     # Refresh partition table to recognize new partitions
-    run_command(f"sudo partprobe {DRIVE}", shell=True)
-    run_command("sudo udevadm settle", shell=True)
-    time.sleep(5)
+    reread_partitions(DRIVE, [1])
 
     setup_unencrypted_partition()
 
-def setup_kali_partition():
+def cryptsetup_supports_perf_flags():
+    """Returns True if cryptsetup knows the --perf-no_*_workqueue options (cryptsetup 2.3.4+)."""
+    result = subprocess.run(["cryptsetup", "--help"], capture_output=True, text=True)
+    return "--perf-no_read_workqueue" in result.stdout
+
+def drive_queue_depth(drive):
+    """Returns how many commands the drive can have in flight (1 if the kernel does not report it)."""
+    try:
+        with open(f"/sys/block/{os.path.basename(drive)}/device/queue_depth") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 1
+
+def prompt_passphrase(description):
+    """Asks for a passphrase twice and returns it once both entries match."""
+    flush_log()
+    while True:
+        passphrase = getpass.getpass(f"Enter passphrase for the {description}: ")
+        if not passphrase:
+            print("Passphrase cannot be empty.")
+        elif passphrase != getpass.getpass(f"Confirm passphrase for the {description}: "):
+            print("Passphrases do not match.")
+        else:
+            return passphrase
+
+def setup_encrypted_partitions():
+    """Formats the persistence and (if requested) documents partitions, in parallel when the drive allows it."""
+    if not (CREATE_DOCS and drive_queue_depth(DRIVE) > 1):
+        setup_kali_partition()
+        if CREATE_DOCS:
+            setup_docs_partition()
+        return
+
+    # The two formats touch disjoint partitions, so collect both passphrases up front
+    # and let the long format passes run side by side without competing for the terminal
+    kali_passphrase = prompt_passphrase("Kali persistence partition")
+    docs_passphrase = prompt_passphrase("documents partition")
+    log("Formatting persistence and documents partitions in parallel...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(setup_kali_partition, kali_passphrase),
+            executor.submit(setup_docs_partition, docs_passphrase)
+        ]
+        for future in futures:
+            future.result()
+
+def setup_kali_partition(passphrase=None):
     global DRIVE
     PERSIST_PART = get_partition_name(DRIVE, 2)
 
@@ -343,44 +1149,66 @@ def setup_kali_partition():
         log(f"Error: Partition {PERSIST_PART} does not exist.")
         sys.exit(1)
 
-    run_command(["sudo", "wipefs", "--all", PERSIST_PART])
+    if PERSIST_PART not in WIPED_PARTITIONS:
+        run_command(["sudo", "wipefs", "--all", PERSIST_PART])
 
     log("Configuring encrypted persistence partition...")
 
     if FAST_MODE:
-        luks_format_cmd = (
-            f"sudo cryptsetup luksFormat '{PERSIST_PART}' "
-            f"--type luks1 "
-            f"--cipher aes-cbc-essiv:sha256 "
-            f"--key-size 256 "
-            f"--hash sha256 "
-            f"--iter-time 1000"
-        )
-        mkfs_cmd = f"sudo mkfs.ext3 -L persistence /dev/mapper/kali_USB"
+        luks_format_cmd = [
+            "sudo", "cryptsetup", "luksFormat", PERSIST_PART,
+            "--type", "luks1",
+            "--cipher", "aes-cbc-essiv:sha256",
+            "--key-size", "256",
+            "--hash", "sha256",
+            "--iter-time", "1000"
+        ]
+        mkfs_cmd = ["sudo", "mkfs.ext3", "-L", "persistence", "/dev/mapper/kali_USB"]
     else:
-        luks_format_cmd = (
-            f"sudo cryptsetup luksFormat '{PERSIST_PART}' "
-            f"--cipher aes-xts-plain64 "
-            f"--key-size 512 "
-            f"--hash sha512 "
-            f"--iter-time 5000"
-        )
-        mkfs_cmd = f"sudo mkfs.ext4 -L persistence /dev/mapper/kali_USB"
-
-    run_command(luks_format_cmd, shell=True, interactive=True)
-    time.sleep(2)
-    run_command(f"sudo cryptsetup luksOpen '{PERSIST_PART}' kali_USB", shell=True, interactive=True)
-    run_command(mkfs_cmd, shell=True)
-
-    run_command("sudo mkdir -p /mnt/kali_USB", shell=True)
-    run_command("sudo mount /dev/mapper/kali_USB /mnt/kali_USB", shell=True)
-    run_command('echo "/ union" | sudo tee /mnt/kali_USB/persistence.conf', shell=True)
-    run_command("sudo umount /mnt/kali_USB", shell=True)
-    run_command("sudo cryptsetup luksClose kali_USB", shell=True)
+        luks_format_cmd = [
+            "sudo", "cryptsetup", "luksFormat", PERSIST_PART,
+            "--type", "luks2",
+            "--sector-size", "4096",
+            "--cipher", "aes-xts-plain64",
+            "--key-size", "512",
+            "--hash", "sha512",
+            "--pbkdf", LUKS_PBKDF,
+            "--iter-time", str(LUKS_ITER_TIME)
+        ]
+        # Defer inode table and journal zeroing to the kernel after first mount, and skip the
+        # discard pass, which dm-crypt rejects by default anyway; -F keeps mke2fs from stopping to ask
+        mkfs_cmd = ["sudo", "mkfs.ext4", "-F", "-L", "persistence", "-E", "lazy_itable_init=1,lazy_journal_init=1,nodiscard",
+                    "/dev/mapper/kali_USB"]
+
+    luks_open_cmd = ["sudo", "cryptsetup", "luksOpen", PERSIST_PART, "kali_USB"]
+    if cryptsetup_supports_perf_flags():
+        # Let dm-crypt encrypt inline instead of bouncing every bio through its workqueues
+        luks_open_cmd += ["--perf-no_read_workqueue", "--perf-no_write_workqueue"]
+
+    if passphrase is None:
+        run_command(luks_format_cmd, interactive=True)
+        time.sleep(2)
+        run_command(luks_open_cmd, interactive=True)
+    else:
+        run_command(luks_format_cmd + ["--batch-mode", "--key-file", "-"], input_text=passphrase)
+        time.sleep(2)
+        run_command(luks_open_cmd + ["--key-file", "-"], input_text=passphrase)
+
+    # Create the file system, write persistence.conf and lock the volume again in one privileged shell invocation
+    # (luksOpen stays separate because it needs the passphrase on its own stdin)
+    run_command([
+        "sudo", "bash", "-c",
+        f"{shlex.join(strip_sudo(mkfs_cmd))} && "
+        "mkdir -p /mnt/kali_USB && "
+        "mount /dev/mapper/kali_USB /mnt/kali_USB && "
+        "echo '/ union' > /mnt/kali_USB/persistence.conf && "
+        "umount /mnt/kali_USB && "
+        "cryptsetup luksClose kali_USB"
+    ])
 
     log("Kali persistence setup complete.")
 
-def setup_docs_partition():
+def setup_docs_partition(passphrase=None):
     global DRIVE
     DOCS_PART = get_partition_name(DRIVE, get_last_partition_number() - 1)
 
@@ -389,34 +1217,59 @@ def setup_docs_partition():
         log(f"Error: Partition {DOCS_PART} does not exist.")
         sys.exit(1)
 
-    run_command(["sudo", "wipefs", "--all", DOCS_PART])
+    if DOCS_PART not in WIPED_PARTITIONS:
+        run_command(["sudo", "wipefs", "--all", DOCS_PART])
 
     log("Configuring VeraCrypt encryption for documents partition...")
 
     if FAST_MODE:
-        veracrypt_create_cmd = (
-            f"veracrypt --text --create '{DOCS_PART}' "
-            f"--encryption AES "
-            f"--hash SHA-256 "
-            f"--filesystem exfat "
-            f"--volume-type normal "
-            f"--quick "
-        )
+        veracrypt_create_cmd = [
+            "veracrypt", "--text", "--create", DOCS_PART,
+            "--encryption", "AES",
+            "--hash", "SHA-256",
+            "--pim", "0",
+            "--filesystem", "exfat",
+            "--volume-type", "normal",
+            "--quick"
+        ]
     else:
-        veracrypt_create_cmd = (
-            f"veracrypt --text --create '{DOCS_PART}' "
-            f"--encryption AES-Twofish-Serpent "
-            f"--hash whirlpool "
-            f"--filesystem exfat "
-            f"--volume-type normal "
-        )
-
-    run_command(veracrypt_create_cmd, shell=True, interactive=True)
+        veracrypt_create_cmd = [
+            "veracrypt", "--text", "--create", DOCS_PART,
+            "--encryption", "AES-Twofish-Serpent",
+            "--hash", "sha512",
+            "--pim", "0",
+            "--filesystem", "exfat",
+            "--volume-type", "normal"
+        ]
+
+    if passphrase is None:
+        run_command(veracrypt_create_cmd, interactive=True)
+    else:
+        veracrypt_create_cmd += ["--keyfiles", "", "--random-source", "/dev/urandom", "--non-interactive", "--stdin"]
+        run_command(veracrypt_create_cmd, input_text=passphrase + "\n")
     log("Encrypted documents partition setup complete.")
 
-def setup_unencrypted_partition():
+def write_root_file(path, contents, executable=False):
+    """Writes contents to a root-owned path: directly when running as root, otherwise with a single sudo process."""
+    if os.geteuid() == 0:
+        try:
+            with open(path, "w") as f:
+                f.write(contents)
+            if executable:
+                os.chmod(path, os.stat(path).st_mode | 0o111)  # Same as chmod +x
+        except OSError as e:
+            log(f"Error writing {path}: {e}")
+            sys.exit(1)
+    elif executable:
+        run_command(["sudo", "install", "-m", "755", "/dev/stdin", path], input_text=contents)
+    else:
+        run_command(["sudo", "dd", f"of={path}", "status=none"], input_text=contents)
+
+def setup_unencrypted_partition(docs_partition=None):
+    """Formats the last partition as FAT32 and writes the helper scripts, defaulting them to docs_partition if given."""
     global DRIVE
     UNENCRYPTED_PART = get_partition_name(DRIVE, get_last_partition_number())
+    DOCS_PART = get_partition_name(DRIVE, docs_partition) if docs_partition else "/dev/sdc1"
 
     # Check if the partition exists
     if not os.path.exists(UNENCRYPTED_PART):
@@ -424,107 +1277,41 @@ def setup_unencrypted_partition():
         sys.exit(1)
 
     log(f"Attempting to format partition {UNENCRYPTED_PART} with FAT32 filesystem.")
-    run_command(f"sudo mkfs.vfat -n 'TOOLS' {UNENCRYPTED_PART}", shell=True)
+    run_command(["sudo", "mkfs.vfat", "-n", "TOOLS", UNENCRYPTED_PART])
     log("Formatted unencrypted partition with FAT32 filesystem.")
 
-    run_command("sudo mkdir -p /mnt/unencrypted", shell=True)
-    run_command(f"sudo mount {UNENCRYPTED_PART} /mnt/unencrypted", shell=True)
-
-    instructions = f"""
-To mount the encrypted documents partition, use the provided 'mount_encrypted_partitions.sh' script.
-To unmount and lock it, use the 'cleanup_encrypted_partitions.sh' script.
-
-**Automount Script:**
-Run: sudo ./mount_encrypted_partitions.sh
-
-**Cleanup Script:**
-Run: sudo ./cleanup_encrypted_partitions.sh
-"""
+    run_command(["sudo", "mkdir", "-p", "/mnt/unencrypted"])
+    run_command(["sudo", "mount", UNENCRYPTED_PART, "/mnt/unencrypted"])
 
-    with open("/tmp/README.txt", "w") as readme_file:
-        readme_file.write(instructions)
-    run_command("sudo cp /tmp/README.txt /mnt/unencrypted/README.txt", shell=True)
-    run_command("sudo rm /tmp/README.txt", shell=True)
+    write_root_file("/mnt/unencrypted/README.txt", README_TEXT)
     log("Created README.txt with mounting instructions.")
 
-    mount_script = """#!/bin/bash
-# Script to mount encrypted documents partition
-
-echo "Available drives:"
-lsblk -o NAME,SIZE,TYPE | grep disk
-read -p "Enter the drive path for the documents partition (default: /dev/sdc1): " DRIVE_PATH
-DRIVE_PATH=${DRIVE_PATH:-/dev/sdc1}
-
-if [ -b "$DRIVE_PATH" ]; then
-    echo "Mounting VeraCrypt documents partition at $DRIVE_PATH..."
-    sudo mkdir -p /mnt/veracrypt_docs
-    sudo veracrypt --text --mount "$DRIVE_PATH" /mnt/veracrypt_docs
-    echo "Documents partition mounted at /mnt/veracrypt_docs."
-else
-    echo "Error: Partition $DRIVE_PATH not found."
-fi
-"""
-
-    with open("/tmp/mount_encrypted_partitions.sh", "w") as script_file:
-        script_file.write(mount_script)
-    run_command("sudo cp /tmp/mount_encrypted_partitions.sh /mnt/unencrypted/mount_encrypted_partitions.sh", shell=True)
-    run_command("sudo chmod +x /mnt/unencrypted/mount_encrypted_partitions.sh", shell=True)
-    run_command("sudo rm /tmp/mount_encrypted_partitions.sh", shell=True)
+    write_root_file("/mnt/unencrypted/mount_encrypted_partitions.sh",
+                    MOUNT_SCRIPT_TEMPLATE.substitute(docs_part=DOCS_PART), executable=True)
     log("Created mount_encrypted_partitions.sh script.")
 
-    cleanup_script = """#!/bin/bash
-# Script to unmount and lock encrypted documents partition
-
-echo "Available drives:"
-lsblk -o NAME,SIZE,TYPE | grep disk
-read -p "Enter the drive path for the documents partition (default: /dev/sdc1): " DRIVE_PATH
-DRIVE_PATH=${DRIVE_PATH:-/dev/sdc1}
-
-echo "Unmounting and locking encrypted documents partition at $DRIVE_PATH..."
-
-if mountpoint -q /mnt/veracrypt_docs; then
-    sudo veracrypt --text --dismount /mnt/veracrypt_docs
-    echo "VeraCrypt documents partition unmounted."
-else
-    echo "Documents partition is not currently mounted."
-fi
-"""
-
-    with open("/tmp/cleanup_encrypted_partitions.sh", "w") as script_file:
-        script_file.write(cleanup_script)
-    run_command("sudo cp /tmp/cleanup_encrypted_partitions.sh /mnt/unencrypted/cleanup_encrypted_partitions.sh", shell=True)
-    run_command("sudo chmod +x /mnt/unencrypted/cleanup_encrypted_partitions.sh", shell=True)
-    run_command("sudo rm /tmp/cleanup_encrypted_partitions.sh", shell=True)
+    write_root_file("/mnt/unencrypted/cleanup_encrypted_partitions.sh",
+                    CLEANUP_SCRIPT_TEMPLATE.substitute(docs_part=DOCS_PART), executable=True)
     log("Created cleanup_encrypted_partitions.sh script.")
 
-    run_command("sudo umount /mnt/unencrypted", shell=True)
+    run_command(["sudo", "umount", "/mnt/unencrypted"])
     log("Unencrypted partition setup complete.")
 
 def get_last_partition_number():
     """Returns the highest partition number on the DRIVE."""
-    result = subprocess.run(["lsblk", "-ln", "-o", "NAME", DRIVE], capture_output=True, text=True)
-    partitions = [line.strip() for line in result.stdout.strip().splitlines() if line.strip()]
-    partition_numbers = []
-    for part in partitions:
-        if 'p' in part:
-            # Handle /dev/nvme0n1p1 format
-            if part.startswith(os.path.basename(DRIVE)):
-                num = part.replace(os.path.basename(DRIVE), '').replace('p', '')
-                if num.isdigit():
-                    partition_numbers.append(int(num))
-        else:
-            # Handle /dev/sda1 format
-            if part.startswith(os.path.basename(DRIVE)):
-                num = part.replace(os.path.basename(DRIVE), '')
-                if num.isdigit():
-                    partition_numbers.append(int(num))
-    if not partition_numbers:
+    # Matches both /dev/sda1 and /dev/nvme0n1p1 style names
+    pattern = re.compile(rf"^{re.escape(DRIVE)}p?(\d+)$")
+    last_partition = max(
+        (int(m.group(1)) for device in iter_block_devices(lsblk_devices(DRIVE)) if (m := pattern.match(device['name']))),
+        default=None
+    )
+    if last_partition is None:
         log(f"No partitions found on {DRIVE}.")
         sys.exit(1)
-    return max(partition_numbers)
+    return last_partition
 
 def main():
-    global DEBUG, FAST_MODE, CREATE_KALI, CREATE_DOCS, CREATE_TAILS, KALI_ISO, TAILS_ISO, DRIVE
+    global DEBUG, FAST_MODE, CREATE_KALI, CREATE_DOCS, CREATE_TAILS, KALI_ISO, TAILS_ISO, ISO_SHA256, DRIVE, BLOCK_SIZE, WIPE_FAST_PATH, LUKS_ITER_TIME, LUKS_PBKDF, ASSUME_YES
 
     parser = argparse.ArgumentParser(description="Covert SD Card Tool")
     parser.add_argument("-a", "--all", action="store_true", help="Set up both OS bootable USB and documents partition")
@@ -532,7 +1319,13 @@ def main():
     parser.add_argument("-d", "--docs", action="store_true", help="Create encrypted documents partition")
     parser.add_argument("-t", "--tails", action="store_true", help="Create Tails bootable USB (no persistence)")
     parser.add_argument("-i", "--iso", help="Path to the Kali or Tails ISO file")
+    parser.add_argument("--sha256", help="Expected SHA-256 checksum of the ISO file")
     parser.add_argument("--fast", action="store_true", help="Enable fast setup with less secure encryption")
+    parser.add_argument("--iter-time", type=int, default=LUKS_ITER_TIME, help="Milliseconds to spend deriving the LUKS persistence key [Default: 5000]")
+    parser.add_argument("--pbkdf", choices=["argon2id", "argon2i", "pbkdf2"], default=LUKS_PBKDF, help="Key derivation function for the LUKS persistence partition [Default: argon2id]")
+    parser.add_argument("--bs", "--dd-bs", dest="bs", type=parse_size, help="Block size for the ISO write and the wipe (e.g., 4M) [Default: 16M, aligned to the drive's optimal I/O size]")
+    parser.add_argument("--no-wipe-fast-path", action="store_true", help="Always zero the start of the drive when wiping instead of trying to discard it first")
+    parser.add_argument("-y", "--yes", action="store_true", help="Answer yes to every y/n question (including wiping the drive)")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
 
     args = parser.parse_args()
@@ -545,10 +1338,18 @@ def main():
     if DEBUG:
         log("Debug mode enabled")
 
+    ASSUME_YES = args.yes
+
     FAST_MODE = args.fast
     if FAST_MODE:
         log("Fast mode enabled: Using less secure encryption for quicker setup.")
 
+    LUKS_ITER_TIME = args.iter_time
+    LUKS_PBKDF = args.pbkdf
+
+    BLOCK_SIZE = args.bs
+    WIPE_FAST_PATH = not args.no_wipe_fast_path
+
     if args.all:
         CREATE_DOCS = True
         if args.tails:
@@ -566,14 +1367,17 @@ def main():
         elif CREATE_TAILS:
             TAILS_ISO = args.iso
 
+    if args.sha256:
+        ISO_SHA256 = args.sha256
+
     check_dependencies()
 
     if CREATE_KALI or CREATE_TAILS or CREATE_DOCS:
         setup_usb()
     else:
-        list_drives()
-        DRIVE = input("Enter the drive to use (e.g., /dev/sda) [Default: /dev/sda]: ") or "/dev/sda"
-        prepare_drive(DRIVE)
+        devices = list_drives()
+        DRIVE = ask("Enter the drive to use (e.g., /dev/sda) [Default: /dev/sda]: ") or "/dev/sda"
+        prepare_drive(DRIVE, devices)
 
         if CREATE_DOCS:
             fix_partition_table_docs_only()